@@ -1,822 +1,1246 @@
-"""
-Small addon for blender to help with rendering in VSE.
-It automates rendering with multiple instances of blender.
-
-It should come up as "Parallel Render" in addons list.
-
-Copyright (c) 2017 Krzysztof Trzcinski
-"""
-
-from bpy import props
-from bpy import types
-from collections import namedtuple
-from enum import Enum
-from multiprocessing import cpu_count
-from multiprocessing.dummy import Pool
-from queue import Queue
-from threading import Lock
-from threading import Thread
-import bpy
-import errno
-import itertools
-import json
-import logging
-import os
-import shutil
-import socket
-import struct
-import subprocess
-import sys
-import tempfile
-import time
-
-LOGGER = logging.getLogger(__name__)
-
-bl_info = {
-    "name": "Parallel Render",
-    "author": "Krzysztof Trzciński",
-    "version": (1, 0),
-    "blender": (2, 91, 0),
-    "location": "Properties > Parallel Render Panel or Render menu",
-    "description": "Render the output from the Sequencer multithreaded",
-    "warning": "",
-    "wiki_url": "https://github.com/elmopl/ktba/wiki/Addons#parallel-render",
-    "tracker_url": "",
-    "category": "Sequencer",
-}
-
-def _can_concatenate(scene):
-    return scene.render.is_movie_format
-
-class ParallelRenderPanel(bpy.types.Panel):
-    """Render the Output from the Sequencer Multithreaded"""
-    bl_label = "Parallel Render"
-    bl_idname = "OBJECT_PT_parallel_render"
-    bl_space_type = 'PROPERTIES'
-    bl_region_type = 'WINDOW'
-    bl_context = "render"
-    bl_parent_id = "RENDER_PT_output"
-
-    def draw(self, context):
-        layout = self.layout
-        layout.use_property_split = True
-        layout.use_property_decorate = False
-
-        layout.operator('render.parallel_render', icon='RENDER_ANIMATION')
-
-        addon_props = context.preferences.addons[__name__].preferences
-        props = context.scene.parallel_render_panel
-
-        layout.prop(props, "max_parallel")
-
-        layout.prop(props, "batch_type", expand=True)
-        sub_prop = str(props.batch_type)
-        if hasattr(props, sub_prop):
-            layout.prop(props, sub_prop)
-
-        layout.prop(props, "overwrite")
-        layout.prop(props, "mixdown")
-
-        col = layout.column()
-        col.prop(props, "concatenate")
-        if not _can_concatenate(context.scene):
-            col.enabled = False
-            col.label(text='Concatenation only available for video file format', icon='ERROR')
-        elif addon_props.ffmpeg_valid:
-            col = layout.column()
-            col.prop(props, "clean_up_parts")
-            col.enabled = props.concatenate
-        else:
-            col.enabled = False
-            col.use_property_split = False
-            col.label(text='Check add-on preferences', icon='ERROR')
-
-
-class MessageChannel(object):
-    MSG_SIZE_FMT = '!i'
-    MSG_SIZE_SIZE = struct.calcsize(MSG_SIZE_FMT)
-
-    def __init__(self, conn):
-        self._conn = conn
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, exc_t, exc_v, tb):
-        self._conn.close()
-
-    def send(self, msg):
-        msg = json.dumps(msg).encode('utf8')
-        msg_size = len(msg)
-        packed_size = struct.pack(self.MSG_SIZE_FMT, msg_size)
-        self._conn.sendall(packed_size)
-        self._conn.sendall(msg)
-
-    def _recv(self, size):
-        buf = b''
-        while len(buf) < size:
-            read = self._conn.recv(size - len(buf))
-            if len(read) == 0:
-                raise Exception('Unexpected end of connection')
-            buf += read
-        return buf
-
-    def recv(self):
-        msg_size_packed = self._recv(self.MSG_SIZE_SIZE)
-        msg_size = struct.unpack(self.MSG_SIZE_FMT, msg_size_packed)[0]
-        if msg_size == 0:
-            return None
-        return json.loads(self._recv(msg_size).decode('utf8'))
-
-
-class CurrentProjectFile(object):
-    def __init__(self):
-        self.path = None
-
-    def __enter__(self):
-        self.path = bpy.data.filepath
-        return self
-
-    def __exit__(self, exc_type, exc_value, tb):
-        self.path = None
-
-
-class TemporaryProjectCopy(object):
-    def __init__(self):
-        self.path = None
-
-    def __enter__(self):
-        project_file = tempfile.NamedTemporaryFile(
-            delete=False,
-            # Temporary project files has to be in the
-            # same directory to ensure relative paths work.
-            dir=bpy.path.abspath("//"),
-            prefix='parallel_render_copy_{}_'.format(os.path.splitext(os.path.basename(bpy.data.filepath))[0]),
-            suffix='.blend',
-        )
-        project_file.close()
-        try:
-            self.path = project_file.name
-
-            bpy.ops.wm.save_as_mainfile(
-                filepath=self.path,
-                copy=True,
-                check_existing=False,
-                relative_remap=True,
-            )
-
-            assert os.path.exists(self.path)
-            return self
-        except:
-            self._cleanup()
-            raise
-
-    def __exit__(self, exc_type, exc_value, tb):
-        self._cleanup()
-
-    def _cleanup(self):
-        os.unlink(self.path)
-        self._cleanup_autosave_files()
-
-    def _cleanup_autosave_files(self):
-        # TODO: Work out proper way to clean up .blend{n} files
-        try:
-            n = 1
-            while True:
-                os.unlink(self.path + str(n))
-                n += 1
-        except OSError:
-            pass
-
-
-class WorkerProcess(object):
-    CONNECT_TIMEOUT = 30
-
-    @staticmethod
-    def read_config():
-        config = json.load(sys.stdin)
-        sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sck.connect(tuple(config['controller']))
-        return MessageChannel(sck), config['args']
-
-    def __init__(
-        self,
-        worker_id,
-        args,
-        project_file,
-        subprocess_stdout,
-        subprocess_stderr
-    ):
-        self._args = args
-        self._p = None
-        self._incoming = None
-        self._sck = None
-        self._project_file = project_file
-        self._logger = LOGGER.getChild('worker[{}]'.format(worker_id))
-        self._connection = None
-        self.return_code = None
-        self.subprocess_stdout = subprocess_stdout
-        self.subprocess_stderr = subprocess_stderr
-
-    def _create_socket(self):
-        self._sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._sck.bind(('localhost', 0))
-        self._sck.listen(1)
-
-    def _detroy_socket(self):
-        self._sck.close()
-
-    def __enter__(self):
-        cmd = (
-            bpy.app.binary_path,
-            self._project_file,
-            '--background',
-            '--python',
-            __file__,
-            '--',
-            'render'
-        )
-
-        self._create_socket()
-
-        self._logger.info("Starting worker process: %s", cmd)
-        self._p = subprocess.Popen(
-            cmd,
-            stdin=subprocess.PIPE,
-            stdout=self.subprocess_stdout,
-            stderr=self.subprocess_stderr,
-        )
-
-        config = {
-            'controller': self._sck.getsockname(),
-            'args': self._args
-        }
-
-        self._p.stdin.write(json.dumps(config).encode('utf8'))
-        self._p.stdin.close()
-
-        # This is rather arbitrary.
-        # It is meant to protect accept() from hanging in case
-        # something very wrong happens to launched process.
-        self._sck.settimeout(self.CONNECT_TIMEOUT)
-
-        self._connection, _addr = self._sck.accept()
-        self._logger.info("Started worker process")
-        return MessageChannel(self._connection)
-
-    def __exit__(self, exc_t, exc_v, tb):
-        self._logger.info('waiting')
-        self.return_code = self._p.wait()
-        self._logger.info('finished with rc: %s', self.return_code)
-        self._p = None
-
-        self._connection.close()
-        self._connection = None
-
-        self._detroy_socket()
-
-
-def _add_multiline_label(layout, lines, icon='NONE'):
-    for line in lines:
-        row = layout.row()
-        row.alignment = 'CENTER'
-        row.label(text=line, icon=icon)
-        icon = 'NONE'
-
-
-def _is_valid_ffmpeg_executable(path):
-    res = None
-
-    try:
-        subprocess.check_output((path, '-version'))
-    except (OSError, subprocess.CalledProcessError):
-        res = "Path `{}` cannot be executed".format(path)
-
-    LOGGER.info("_is_valid_ffmpeg_executable(%s): %s", path, res)
-    return res
-
-
-class ParallelRenderPreferences(types.AddonPreferences):
-    bl_idname = __name__
-
-    ffmpeg_executable: props.StringProperty(
-        name="Path to ffmpeg executable",
-        default="",
-        update=lambda self, context: self.update(context),
-        subtype='FILE_PATH',
-    )
-
-    ffmpeg_status: props.StringProperty(default="")
-    ffmpeg_valid: props.BoolProperty(default=False)
-
-    def update(self, context):
-        error = _is_valid_ffmpeg_executable(self.ffmpeg_executable)
-        if error is None:
-            self.ffmpeg_valid = True
-            info = subprocess.check_output((self.ffmpeg_executable, '-version')).decode('utf-8')
-            info = info.split('\r', 1)[0]
-            self.ffmpeg_status = 'Version: {}'.format(info)
-        else:
-            self.ffmpeg_valid = False
-            self.ffmpeg_status = error
-            context.scene.parallel_render_panel.update(context)
-
-    def draw(self, context):
-        layout = self.layout
-        layout.prop(self, "ffmpeg_executable")
-        icon = 'INFO' if self.ffmpeg_valid else 'ERROR'
-        if icon == 'ERROR':
-            layout.label(text="The path to FFmpeg executable is invalid.", icon=icon)
-        else:
-            layout.label(text=self.ffmpeg_status, icon=icon)
-
-
-def _need_temporary_file(data):
-    return data.is_dirty
-
-
-def parallel_render_menu_draw(self, context):
-    layout = self.layout
-    layout.operator('render.parallel_render', icon='RENDER_ANIMATION')
-    layout.separator()
-
-
-class ParallelRenderPropertyGroup(types.PropertyGroup):
-    def update(self, context):
-        addon_props = context.preferences.addons[__name__].preferences
-
-        if not addon_props.ffmpeg_valid and self.concatenate:
-            LOGGER.info("ParallelRenderPropertyGroup forcing concatenate to false")
-            self.concatenate = False
-            self.clean_up_parts = False
-
-        if not self.concatenate:
-            self.clean_up_parts = False
-
-    last_run_result: props.EnumProperty(
-        items=[
-            # (identifier, name, description, icon, number)
-            ('done', '', ''),
-            ('pending', '', ''),
-            ('failed', '', ''),
-        ],
-        name="Render Batch Size"
-    )
-
-    batch_type: props.EnumProperty(
-        items=[
-            # (identifier, name, description, icon, number)
-            ('parts', 'Parts', 'Render in given number of batches (automatically splits it)'),
-            ('fixed', 'Fixed', 'Render in fixed size batches'),
-        ],
-        name="Render Batch Size"
-    )
-
-    max_parallel: props.IntProperty(
-        name="Blender Instances",
-        min=1,
-        default=cpu_count() - 1,
-        max=10000
-    )
-
-    overwrite: props.BoolProperty(
-        name="Overwrite Existing Files",
-        default=True,
-    )
-
-    mixdown: props.BoolProperty(
-        name="Mixdown Sound",
-        default=True,
-    )
-
-    concatenate: props.BoolProperty(
-        name="Concatenate Output Files",
-        update=lambda self, context: self.update(context),
-    )
-
-    clean_up_parts: props.BoolProperty(
-        name="Clean Up Partial Files",
-    )
-
-    fixed: props.IntProperty(
-        name="Number of Frames per Batch",
-        min=1,
-        default=300,
-        max=10000
-    )
-
-    parts: props.IntProperty(
-        name="Number of Parts",
-        min=1,
-        default=(cpu_count()-1) * 2,
-        max=10000
-    )
-
-
-class ParallelRenderState(Enum):
-    CLEANING = 1
-    RUNNING = 2
-    MIXDOWN = 3
-    CONCATENATE = 4
-    FAILED = 5
-    CANCELLING = 6
-
-    def describe(self):
-        return {
-            self.CLEANING: ('INFO', 'Cleaning Up'),
-            self.RUNNING: ('INFO', 'Rendering'),
-            self.MIXDOWN: ('INFO', 'Mixing Sound'),
-            self.CONCATENATE: ('INFO', 'Concatenating'),
-            self.FAILED: ('ERROR', 'Failed'),
-            self.CANCELLING: ('WARNING', 'Cancelling'),
-        }[self]
-
-
-def get_ranges_parts(scn):
-    offset = scn.frame_start
-    current = 0
-    end = scn.frame_end - offset
-    length = end + 1
-    parts = int(scn.parallel_render_panel.parts)
-
-    if length <= parts:
-        yield (scn.frame_start, scn.frame_end)
-        return
-
-    for i in range(1, parts + 1):
-        end = i * length // parts
-        yield (offset + current, offset + end - 1)
-        current = end
-
-
-def get_ranges_fixed(scn):
-    start = scn.frame_start
-    end = scn.frame_end
-    increment = int(scn.parallel_render_panel.fixed)
-    while start <= end:
-        yield (start, min(start + increment, end))
-        start += increment + 1
-
-RANGE_CALCULATORS = {
-    'parts': get_ranges_parts,
-    'fixed': get_ranges_fixed,
-}
-
-
-class ParallelRender(types.Operator):
-    """Render the Output from the Sequencer Multithreaded"""
-    bl_idname = "render.parallel_render"
-    bl_label = "Parallel Render"
-    bl_options = {'REGISTER'}
-
-    still_running = False
-    thread = None
-    state = None
-    subprocess_stdout = sys.stdout
-    subprocess_stderr = sys.stderr
-
-    def draw(self, context):
-        layout = self.layout
-        if _need_temporary_file(bpy.data):
-            _add_multiline_label(
-                layout,
-                [
-                    'Unsaved changes to project.',
-                    'Will attempt to create temporary file.',
-                ],
-                icon='ERROR',
-            )
-
-        layout.row().label(text='Will render frames from {} to {}'.format(context.scene.frame_start, context.scene.frame_end))
-
-    def __init__(self):
-        super(ParallelRender, self).__init__()
-        self.summary_mutex = None
-
-    def check(self, context):
-        return True
-
-    def _render_project_file(self, scn, project_file):
-        LOGGER.info("Going to render file %s", project_file)
-        self.summary_mutex = Lock()
-
-        props = scn.parallel_render_panel
-
-        range_type = str(props.batch_type)
-        ranges = tuple(RANGE_CALCULATORS[range_type](scn))
-
-        cmds = tuple(
-            (
-                (start, end),
-                {
-                    '--scene': str(scn.name),
-                    '--start-frame': start,
-                    '--end-frame': end,
-                    '--overwrite': bool(props.overwrite),
-                }
-            )
-            for start, end in ranges
-        )
-
-        self.summary = {
-            'batches': len(cmds),
-            'batches_done': 0,
-            'frames': max(s[1] for s in ranges) - min(s[0] for s in ranges) + 1,
-            'frames_done': 0,
-        }
-        RunResult = namedtuple('RunResult', ('range', 'command', 'rc', 'output_file'))
-
-        self.report({'INFO'}, 'Working on file {0}'.format(project_file))
-
-        def run(args):
-            rng, cmd = args
-            res = None
-            output_file = None
-
-            if self.state == ParallelRenderState.RUNNING:
-                try:
-                    worker_id = '{}-{}'.format(rng[0], rng[1])
-                    worker = WorkerProcess(
-                        worker_id,
-                        cmd,
-                        project_file=project_file,
-                        subprocess_stdout=self.subprocess_stdout,
-                        subprocess_stderr=self.subprocess_stderr,
-                    )
-                    msg = None
-                    with worker as channel:
-                        msgs = iter(channel.recv, None)
-                        last_done = rng[0]
-                        for msg in msgs:
-                            frame_done = msg['current_frame']
-                            with self.summary_mutex:
-                                self.summary['frames_done'] += (frame_done - last_done)
-                            last_done = frame_done
-
-                        with self.summary_mutex:
-                            self.summary['frames_done'] += 1
-
-                    res = worker.return_code
-
-                    if msg is not None:
-                        output_file = msg['output_file']
-                        status_msg = 'Worker finished writing {}'.format(output_file)
-                        LOGGER.info(status_msg)
-                except Exception as exc:
-                    LOGGER.exception(exc)
-                    res = -1
-            return RunResult(rng, cmd, res, output_file)
-
-        self.state = ParallelRenderState.RUNNING
-        self.report({'INFO'}, 'Starting 0/{0} [0.0%]'.format(
-            len(cmds)
-        ))
-
-        with Pool(props.max_parallel) as pool:
-            pending = pool.imap_unordered(run, cmds)
-            results = {}
-            for num, res in enumerate(pending, 1):
-                with self.summary_mutex:
-                    self.summary['batches_done'] = num
-                results[res.range] = res
-                self._report_progress()
-
-        for result in sorted(results.values(), key=lambda r: r.range[0]):
-            LOGGER.info('Result: %s', result)
-            if result.rc != 0:
-                self.state = ParallelRenderState.FAILED
-                if result.output_file is not None:
-                    LOGGER.error('Cleaning up failed %s', result.output_file)
-                    try:
-                        os.unlink(result.output_file)
-                    except OSError as exc:
-                        assert exc.errno == errno.ENOENT
-
-        self._report_progress()
-
-        sound_path = os.path.abspath(os.path.splitext(scn.render.frame_path())[0] + '.mp3')
-        if self.state == self.state.RUNNING and props.mixdown:
-            self.state = ParallelRenderState.MIXDOWN
-            with self.summary_mutex:
-                self.report({'INFO'}, 'Mixing down sound')
-                logging.info('Going to mixdown to %s')
-                bpy.ops.sound.mixdown(filepath=sound_path)
-            self._report_progress()
-            self.state = ParallelRenderState.RUNNING
-
-        LOGGER.debug('Checkpoint %s %s %s', self.state, props.concatenate, _can_concatenate(scn))
-        if self.state == ParallelRenderState.RUNNING and props.concatenate and _can_concatenate(scn):
-            fd, concatenate_files_name = tempfile.mkstemp(
-                dir=bpy.path.abspath("//"),
-            )
-            os.close(fd)
-            LOGGER.info('Going to concatenate concatenate (list file: %s)', concatenate_files_name)
-
-            self.state = ParallelRenderState.CONCATENATE
-            self.report({'INFO'}, 'Concatenating')
-            with open(concatenate_files_name, 'w') as data:
-                for range, res in sorted(results.items()):
-                    data.write("file '{}'\n".format(res.output_file))
-
-            outfile = bpy.context.scene.render.frame_path()
-            LOGGER.info('Final render name: %s', outfile)
-
-            sound = ()
-            if props.mixdown:
-                sound = ('-i', sound_path, '-codec:a', 'copy', '-q:a', '0')
-
-            overwrite = ('-y' if bool(props.overwrite) else '-n',)
-
-            base_cmd = (
-                self.ffmpeg_executable,
-                '-nostdin',
-                '-f', 'concat',
-                '-safe', '0',
-                '-i', concatenate_files_name,
-                '-codec:v', 'copy',
-                outfile,
-            )
-
-            cmd = base_cmd + sound + overwrite
-
-            LOGGER.info('Running: %s', cmd)
-            res = subprocess.call(
-                cmd,
-                stdout=self.subprocess_stdout,
-                stderr=self.subprocess_stderr,
-            )
-            LOGGER.info('Finished running [rc: %s]: %s',  res, cmd)
-            if res == 0:
-                self.state = self.state.RUNNING
-            else:
-                self.state = self.state.FAILED
-
-            os.unlink(concatenate_files_name)
-
-            assert os.path.exists(outfile)
-
-        if self.state == ParallelRenderState.RUNNING and props.clean_up_parts:
-            to_clean = [res.output_file for res in results.values()]
-            LOGGER.info('Going to clean up parts (%s)', to_clean)
-            self.state = ParallelRenderState.CLEANING
-            os.unlink(sound_path)
-            for filename in to_clean:
-                os.unlink(filename)
-            self.state = ParallelRenderState.RUNNING
-
-    def _run(self, scn):
-        props = scn.parallel_render_panel
-        props.last_run_result = 'pending'
-
-        if _need_temporary_file(bpy.data):
-            work_project_file = TemporaryProjectCopy()
-        else:
-            work_project_file = CurrentProjectFile()
-
-        try:
-            with work_project_file:
-                self._render_project_file(scn, work_project_file.path)
-            props.last_run_result = 'done' if self.state == ParallelRenderState.RUNNING else 'failed'
-        except Exception as exc:
-            LOGGER.exception(exc)
-            props.last_run_result = 'failed'
-
-    def _report_progress(self):
-        rep_type, action = self.state.describe()
-        with self.summary_mutex:
-            self.report({rep_type}, '{0} Batches: {1}/{2} Frames: {3}/{4} [{5:.1f}%]'.format(
-                action.replace('ing', 'ed'),
-                self.summary['batches_done'],
-                self.summary['batches'],
-                self.summary['frames_done'],
-                self.summary['frames'],
-                100.0 * self.summary['frames_done'] / self.summary['frames']
-            ))
-
-    def execute(self, context):
-        scn = context.scene
-        wm = context.window_manager
-        self.timer = wm.event_timer_add(0.5, window=context.window)
-        wm.modal_handler_add(self)
-        wm.progress_begin(0., 100.)
-
-        addon_props = context.preferences.addons[__name__].preferences
-
-        self.max_parallel = scn.parallel_render_panel.max_parallel
-        self.ffmpeg_executable = addon_props.ffmpeg_executable
-
-        self.thread = Thread(target=self._run, args=(scn,))
-        self.thread.start()
-        return {'RUNNING_MODAL'}
-
-    def modal(self, context, event):
-        if self.summary_mutex is None:
-            return {'PASS_THROUGH'}
-
-        wm = context.window_manager
-
-        # Stop the thread when ESCAPE is pressed.
-        if event.type == 'ESC':
-            self.state = ParallelRenderState.CANCELLING
-            self._report_progress()
-
-        if event.type == 'TIMER':
-            still_running = self.thread.is_alive()
-            with self.summary_mutex:
-                percent = 100.0 * self.summary['batches_done'] / self.summary['batches']
-
-            if still_running:
-                wm.progress_update(percent)
-                self._report_progress()
-                return {'PASS_THROUGH'}
-
-            self.thread.join()
-            wm.event_timer_remove(self.timer)
-            wm.progress_end()
-            return {'FINISHED'}
-
-        return {'PASS_THROUGH'}
-
-    def invoke(self, context, event):
-        wm = context.window_manager
-        return wm.invoke_props_dialog(self)
-
-
-def render():
-    channel, args = WorkerProcess.read_config()
-    with channel:
-        try:
-            scn_name = args['--scene']
-            scn = bpy.data.scenes[scn_name]
-            scn.frame_start = args['--start-frame']
-            scn.frame_end = args['--end-frame']
-
-            outfile = bpy.context.scene.render.frame_path()
-
-            def _update_progress(_ignored):
-                send_stats(bpy.context.scene.frame_current)
-
-            def send_stats(frame):
-                channel.send({
-                    'output_file': outfile,
-                    'current_frame':  frame,
-                })
-
-            LOGGER.info("Writing file {}".format(outfile))
-            if args['--overwrite'] or not os.path.exists(outfile):
-                bpy.app.handlers.render_stats.append(_update_progress)
-                bpy.ops.render.render(animation=True, scene=scn_name)
-            else:
-                LOGGER.warning('%s already exists.', outfile)
-
-            send_stats(scn.frame_end)
-            LOGGER.info("Done writing {}".format(outfile))
-            assert os.path.exists(outfile)
-        finally:
-            channel.send(None)
-    sys.exit(0)
-
-
-def main():
-    logging.basicConfig(level=logging.INFO)
-
-    covstart = os.environ.get('COVERAGE_PROCESS_START')
-    if covstart is not None:
-        sys.path.extend(os.environ['PYTHONPATH'].split(':'))
-        logging.info('sys.path: %s', sys.path)
-        import coverage
-        coverage.process_startup()
-
-    # Get everything after '--' as those are arguments
-    # to our script
-    args = sys.argv[sys.argv.index('--') + 1:]
-
-    action = args[0]
-
-    if action == 'render':
-        render()
-
-CLASSES = (
-    ParallelRenderPropertyGroup,
-    ParallelRenderPreferences,
-    ParallelRender,
-    ParallelRenderPanel,
-)
-
-def register():
-    for cls in CLASSES:
-        bpy.utils.register_class(cls)
-
-    bpy.types.Scene.parallel_render_panel = bpy.props.PointerProperty(type=ParallelRenderPropertyGroup)
-    # TODO: I am not quite sure how to put it after actual "Render Animation"
-    bpy.types.TOPBAR_MT_render.prepend(parallel_render_menu_draw)
-
-
-def unregister():
-    bpy.types.TOPBAR_MT_render.remove(parallel_render_menu_draw)
-    del bpy.types.Scene.parallel_render_panel
-    for cls in reversed(CLASSES):
-        bpy.utils.unregister_class(cls)
-
-if __name__ == "__main__":
-    main()
+"""
+Small addon for blender to help with rendering in VSE.
+It automates rendering with multiple instances of blender.
+
+It should come up as "Parallel Render" in addons list.
+
+Copyright (c) 2017 Krzysztof Trzcinski
+"""
+
+from bpy import props
+from bpy import types
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from enum import Enum
+from multiprocessing import cpu_count
+from queue import Empty
+from queue import Queue
+from threading import Event
+from threading import Lock
+from threading import Thread
+import bpy
+import errno
+import glob
+import json
+import logging
+import os
+import selectors
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+# The channel payload encoding only needs to round-trip small dicts of
+# strings and ints, so pick the fastest codec that happens to be
+# installed: msgpack (binary, smallest and quickest to parse), then
+# orjson (C json straight to bytes), then stdlib json.
+try:
+    import msgpack
+
+    def _dumps(obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def _loads(data):
+        return msgpack.unpackb(data, raw=False)
+except ImportError:
+    try:
+        import orjson
+
+        def _dumps(obj):
+            return orjson.dumps(obj)
+
+        def _loads(data):
+            return orjson.loads(data)
+    except ImportError:
+        def _dumps(obj):
+            return json.dumps(obj).encode('utf8')
+
+        def _loads(data):
+            return json.loads(data.decode('utf8'))
+
+LOGGER = logging.getLogger(__name__)
+
+bl_info = {
+    "name": "Parallel Render",
+    "author": "Krzysztof Trzciński",
+    "version": (1, 0),
+    "blender": (2, 91, 0),
+    "location": "Properties > Parallel Render Panel or Render menu",
+    "description": "Render the output from the Sequencer multithreaded",
+    "warning": "",
+    "wiki_url": "https://github.com/elmopl/ktba/wiki/Addons#parallel-render",
+    "tracker_url": "",
+    "category": "Sequencer",
+}
+
+def _can_concatenate(scene):
+    return scene.render.is_movie_format
+
+class ParallelRenderPanel(bpy.types.Panel):
+    """Render the Output from the Sequencer Multithreaded"""
+    bl_label = "Parallel Render"
+    bl_idname = "OBJECT_PT_parallel_render"
+    bl_space_type = 'PROPERTIES'
+    bl_region_type = 'WINDOW'
+    bl_context = "render"
+    bl_parent_id = "RENDER_PT_output"
+
+    def draw(self, context):
+        layout = self.layout
+        layout.use_property_split = True
+        layout.use_property_decorate = False
+
+        layout.operator('render.parallel_render', icon='RENDER_ANIMATION')
+
+        addon_props = context.preferences.addons[__name__].preferences
+        props = context.scene.parallel_render_panel
+
+        layout.prop(props, "max_parallel")
+
+        layout.prop(props, "batch_type", expand=True)
+        sub_prop = str(props.batch_type)
+        if hasattr(props, sub_prop):
+            layout.prop(props, sub_prop)
+        layout.prop(props, "min_frames_per_batch")
+
+        layout.prop(props, "overwrite")
+        layout.prop(props, "mixdown")
+
+        col = layout.column()
+        col.prop(props, "concatenate")
+        if not _can_concatenate(context.scene):
+            col.enabled = False
+            col.label(text='Concatenation only available for video file format', icon='ERROR')
+        elif addon_props.ffmpeg_valid:
+            col = layout.column()
+            col.prop(props, "clean_up_parts")
+            col.enabled = props.concatenate
+        else:
+            col.enabled = False
+            col.use_property_split = False
+            col.label(text='Check add-on preferences', icon='ERROR')
+
+
+class MessageChannel(object):
+    MSG_SIZE_FMT = '!i'
+    # Precompiled so the hot send/recv path does not re-parse the
+    # format string for every message.
+    MSG_SIZE_STRUCT = struct.Struct(MSG_SIZE_FMT)
+    MSG_SIZE_SIZE = MSG_SIZE_STRUCT.size
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_t, exc_v, tb):
+        self._conn.close()
+
+    def send(self, msg):
+        msg = _dumps(msg)
+        packed_size = self.MSG_SIZE_STRUCT.pack(len(msg))
+        # Single sendall so the size prefix and payload go out in
+        # one syscall (and usually one segment).
+        self._conn.sendall(packed_size + msg)
+
+    def _recv(self, size):
+        buf = bytearray(size)
+        view = memoryview(buf)
+        pos = 0
+        while pos < size:
+            read = self._conn.recv_into(view[pos:])
+            if read == 0:
+                raise Exception('Unexpected end of connection')
+            pos += read
+        return bytes(buf)
+
+    def recv(self):
+        msg_size_packed = self._recv(self.MSG_SIZE_SIZE)
+        msg_size = self.MSG_SIZE_STRUCT.unpack(msg_size_packed)[0]
+        if msg_size == 0:
+            return None
+        return _loads(self._recv(msg_size))
+
+
+class CurrentProjectFile(object):
+    def __init__(self):
+        self.path = None
+
+    def __enter__(self):
+        self.path = bpy.data.filepath
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.path = None
+
+
+class TemporaryProjectCopy(object):
+    def __init__(self):
+        self.path = None
+
+    def __enter__(self):
+        project_file = tempfile.NamedTemporaryFile(
+            delete=False,
+            # Temporary project files has to be in the
+            # same directory to ensure relative paths work.
+            dir=bpy.path.abspath("//"),
+            prefix='parallel_render_copy_{}_'.format(os.path.splitext(os.path.basename(bpy.data.filepath))[0]),
+            suffix='.blend',
+        )
+        project_file.close()
+        try:
+            self.path = project_file.name
+
+            bpy.ops.wm.save_as_mainfile(
+                filepath=self.path,
+                copy=True,
+                check_existing=False,
+                relative_remap=True,
+            )
+
+            assert os.path.exists(self.path)
+            return self
+        except:
+            self._cleanup()
+            raise
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._cleanup()
+
+    def _cleanup(self):
+        os.unlink(self.path)
+        self._cleanup_autosave_files()
+
+    def _cleanup_autosave_files(self):
+        # One readdir instead of probing sequential .blend{n} names
+        # with unlink calls until one fails.
+        for path in glob.glob(glob.escape(self.path) + '[0-9]*'):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+class WorkerProcess(object):
+    @staticmethod
+    def read_config():
+        # The config is passed on the command line (it is tiny) rather
+        # than over stdin -- pipe writes to a freshly spawned process
+        # can stall for a long time on some platforms.
+        args = sys.argv[sys.argv.index('--') + 1:]
+        config = json.loads(args[1])
+        endpoint = config['controller']
+        if isinstance(endpoint, str):
+            sck = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sck.connect(endpoint)
+        else:
+            sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # Stats messages are tiny; do not let Nagle hold them back,
+            # and give bursts of them kernel buffer to land in.
+            sck.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sck.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+            sck.connect(tuple(endpoint))
+        channel = MessageChannel(sck)
+        # The controller runs a single shared listener, so identify
+        # ourselves to let it match this connection to our process.
+        channel.send({'hello': config['token']})
+        return channel
+
+    def __init__(
+        self,
+        worker_id,
+        project_file,
+        subprocess_stdout,
+        subprocess_stderr
+    ):
+        self._p = None
+        self._project_file = project_file
+        self._logger = LOGGER.getChild('worker[{}]'.format(worker_id))
+        self._connection = None
+        self.channel = None
+        self.return_code = None
+        self.subprocess_stdout = subprocess_stdout
+        self.subprocess_stderr = subprocess_stderr
+
+    def terminate(self):
+        process = self._p
+        if process is not None:
+            process.terminate()
+
+    def start(self, cmd_prefix, config):
+        cmd = cmd_prefix + ('--', 'render', json.dumps(config))
+
+        self._logger.info("Starting worker process: %s", cmd)
+        self._p = subprocess.Popen(
+            cmd,
+            stdout=self.subprocess_stdout,
+            stderr=self.subprocess_stderr,
+            # Keep workers out of the UI session's process group so a
+            # Ctrl+C aimed at blender does not tear them down behind
+            # the controller's back.
+            start_new_session=True,
+        )
+
+    def attach(self, connection):
+        self._connection = connection
+        self.channel = MessageChannel(connection)
+        self._logger.info("Started worker process")
+
+    def stop(self):
+        if self._p is None:
+            return self.return_code
+
+        try:
+            # Ask the worker loop to finish; if the connection is
+            # already gone the process is on its way out anyway.
+            self.channel.send(None)
+        except OSError:
+            self.terminate()
+
+        self._logger.info('waiting')
+        self.return_code = self._p.wait()
+        self._logger.info('finished with rc: %s', self.return_code)
+        self._p = None
+
+        self._connection.close()
+        self._connection = None
+        return self.return_code
+
+
+class WorkerPool(object):
+    """Keeps worker Blender processes alive across batches.
+
+    Starting Blender and loading the project is by far the biggest
+    fixed cost of a batch, so instead of one process per range each
+    worker renders consecutive ranges until the pool is shut down.
+    Workers are spawned on demand; concurrency is bounded by the
+    executor dispatching the batches.
+    """
+
+    # This is rather arbitrary.
+    # It is meant to protect accept() from hanging in case
+    # something very wrong happens to a launched process.
+    CONNECT_TIMEOUT = 30
+
+    def __init__(self, project_file, subprocess_stdout, subprocess_stderr):
+        self._project_file = project_file
+        # Resolved once; bpy.app.binary_path is an RNA lookup and the
+        # rest of the command line never changes between workers.
+        self._cmd_prefix = (
+            bpy.app.binary_path,
+            project_file,
+            '--background',
+            '--python',
+            __file__,
+        )
+        self._subprocess_stdout = subprocess_stdout
+        self._subprocess_stderr = subprocess_stderr
+        self._mutex = Lock()
+        self._accept_mutex = Lock()
+        self._workers = []
+        self._idle = Queue()
+        self._next_worker_id = 0
+        self._listener = None
+        self._socket_dir = None
+        self._pending_hellos = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_t, exc_v, tb):
+        self.shutdown()
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            return self._spawn()
+
+    def release(self, worker):
+        self._idle.put(worker)
+
+    def discard(self, worker):
+        with self._mutex:
+            self._workers.remove(worker)
+        return worker.stop()
+
+    def shutdown(self):
+        with self._mutex:
+            workers = tuple(self._workers)
+            self._workers = []
+            listener = self._listener
+            self._listener = None
+        for worker in workers:
+            worker.stop()
+        if listener is not None:
+            listener.close()
+        if self._socket_dir is not None:
+            shutil.rmtree(self._socket_dir, ignore_errors=True)
+            self._socket_dir = None
+
+    def _ensure_listener(self):
+        # All workers connect back to one shared listener instead of
+        # each getting its own bind/listen/accept and ephemeral port.
+        with self._mutex:
+            if self._listener is None:
+                if hasattr(socket, 'AF_UNIX'):
+                    # Unix sockets skip the TCP/IP stack entirely for
+                    # the per-frame stats traffic.
+                    self._socket_dir = tempfile.mkdtemp(prefix='parallel_render_')
+                    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    listener.bind(os.path.join(self._socket_dir, 'controller.sock'))
+                else:
+                    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                    listener.bind(('localhost', 0))
+                listener.listen()
+                listener.settimeout(self.CONNECT_TIMEOUT)
+                self._listener = listener
+            return self._listener
+
+    def _wait_for_worker(self, token):
+        while True:
+            with self._accept_mutex:
+                connection = self._pending_hellos.pop(token, None)
+                if connection is not None:
+                    return connection
+                connection, _addr = self._listener.accept()
+                if connection.family == socket.AF_INET:
+                    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    connection.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+                hello = MessageChannel(connection).recv()
+                if hello['hello'] == token:
+                    return connection
+                # Some other spawner's worker connected first;
+                # stash it for them and keep accepting.
+                self._pending_hellos[hello['hello']] = connection
+
+    def _spawn(self):
+        listener = self._ensure_listener()
+        with self._mutex:
+            worker_id = self._next_worker_id
+            self._next_worker_id += 1
+        worker = WorkerProcess(
+            worker_id,
+            project_file=self._project_file,
+            subprocess_stdout=self._subprocess_stdout,
+            subprocess_stderr=self._subprocess_stderr,
+        )
+        worker.start(self._cmd_prefix, {
+            'controller': listener.getsockname(),
+            'token': worker_id,
+        })
+        worker.attach(self._wait_for_worker(worker_id))
+        with self._mutex:
+            self._workers.append(worker)
+        return worker
+
+
+def _add_multiline_label(layout, lines, icon='NONE'):
+    for line in lines:
+        row = layout.row()
+        row.alignment = 'CENTER'
+        row.label(text=line, icon=icon)
+        icon = 'NONE'
+
+
+def _probe_ffmpeg_executable(path):
+    """Run `path -version` once and return an (error, status) pair.
+
+    error is None when the path runs as ffmpeg; status is the text to
+    show in the preferences UI either way.
+    """
+    try:
+        info = subprocess.check_output((path, '-version')).decode('utf-8')
+    except (OSError, subprocess.CalledProcessError):
+        error = "Path `{}` cannot be executed".format(path)
+        LOGGER.info("_probe_ffmpeg_executable(%s): %s", path, error)
+        return error, error
+
+    LOGGER.info("_probe_ffmpeg_executable(%s): ok", path)
+    return None, 'Version: {}'.format(info.split('\r', 1)[0])
+
+
+# Probe results keyed by (path, mtime): update() can fire on UI
+# redraws, and forking ffmpeg for every one of those is wasteful.
+# Entries expire after a minute so a replaced binary is re-probed.
+_FFMPEG_PROBE_CACHE = {}
+_FFMPEG_PROBE_TTL = 60.0
+
+
+class ParallelRenderPreferences(types.AddonPreferences):
+    bl_idname = __name__
+
+    ffmpeg_executable: props.StringProperty(
+        name="Path to ffmpeg executable",
+        default="",
+        update=lambda self, context: self.update(context),
+        subtype='FILE_PATH',
+    )
+
+    ffmpeg_status: props.StringProperty(default="")
+    ffmpeg_valid: props.BoolProperty(default=False)
+
+    def update(self, context):
+        path = self.ffmpeg_executable
+        try:
+            key = (path, os.path.getmtime(path))
+        except OSError:
+            key = (path, None)
+        now = time.monotonic()
+        cached = _FFMPEG_PROBE_CACHE.get(key)
+        if cached is not None and now - cached[0] < _FFMPEG_PROBE_TTL:
+            error, status = cached[1], cached[2]
+        else:
+            error, status = _probe_ffmpeg_executable(path)
+            _FFMPEG_PROBE_CACHE[key] = (now, error, status)
+
+        self.ffmpeg_valid = error is None
+        self.ffmpeg_status = status
+        if error is not None:
+            context.scene.parallel_render_panel.update(context)
+
+    def draw(self, context):
+        layout = self.layout
+        layout.prop(self, "ffmpeg_executable")
+        icon = 'INFO' if self.ffmpeg_valid else 'ERROR'
+        if icon == 'ERROR':
+            layout.label(text="The path to FFmpeg executable is invalid.", icon=icon)
+        else:
+            layout.label(text=self.ffmpeg_status, icon=icon)
+
+
+def _need_temporary_file(data):
+    return data.is_dirty
+
+
+def parallel_render_menu_draw(self, context):
+    layout = self.layout
+    layout.operator('render.parallel_render', icon='RENDER_ANIMATION')
+    layout.separator()
+
+
+class ParallelRenderPropertyGroup(types.PropertyGroup):
+    def update(self, context):
+        addon_props = context.preferences.addons[__name__].preferences
+
+        if not addon_props.ffmpeg_valid and self.concatenate:
+            LOGGER.info("ParallelRenderPropertyGroup forcing concatenate to false")
+            self.concatenate = False
+            self.clean_up_parts = False
+
+        if not self.concatenate:
+            self.clean_up_parts = False
+
+    last_run_result: props.EnumProperty(
+        items=[
+            # (identifier, name, description, icon, number)
+            ('done', '', ''),
+            ('pending', '', ''),
+            ('failed', '', ''),
+        ],
+        name="Render Batch Size"
+    )
+
+    batch_type: props.EnumProperty(
+        items=[
+            # (identifier, name, description, icon, number)
+            ('parts', 'Parts', 'Render in given number of batches (automatically splits it)'),
+            ('fixed', 'Fixed', 'Render in fixed size batches'),
+        ],
+        name="Render Batch Size"
+    )
+
+    max_parallel: props.IntProperty(
+        name="Blender Instances",
+        min=1,
+        default=cpu_count() - 1,
+        max=10000
+    )
+
+    overwrite: props.BoolProperty(
+        name="Overwrite Existing Files",
+        default=True,
+    )
+
+    mixdown: props.BoolProperty(
+        name="Mixdown Sound",
+        default=True,
+    )
+
+    concatenate: props.BoolProperty(
+        name="Concatenate Output Files",
+        update=lambda self, context: self.update(context),
+    )
+
+    clean_up_parts: props.BoolProperty(
+        name="Clean Up Partial Files",
+    )
+
+    fixed: props.IntProperty(
+        name="Number of Frames per Batch",
+        min=1,
+        default=300,
+        max=10000
+    )
+
+    min_frames_per_batch: props.IntProperty(
+        name="Minimum Frames per Batch",
+        description="Merge adjacent batches until each has at least this many frames",
+        min=1,
+        default=1,
+        max=10000
+    )
+
+    parts: props.IntProperty(
+        name="Number of Parts",
+        min=1,
+        default=(cpu_count()-1) * 2,
+        max=10000
+    )
+
+
+class ParallelRenderState(Enum):
+    CLEANING = 1
+    RUNNING = 2
+    MIXDOWN = 3
+    CONCATENATE = 4
+    FAILED = 5
+    CANCELLING = 6
+
+    def describe(self):
+        return {
+            self.CLEANING: ('INFO', 'Cleaning Up'),
+            self.RUNNING: ('INFO', 'Rendering'),
+            self.MIXDOWN: ('INFO', 'Mixing Sound'),
+            self.CONCATENATE: ('INFO', 'Concatenating'),
+            self.FAILED: ('ERROR', 'Failed'),
+            self.CANCELLING: ('WARNING', 'Cancelling'),
+        }[self]
+
+
+def get_ranges_parts(scn):
+    offset = scn.frame_start
+    length = scn.frame_end - offset + 1
+    parts = int(scn.parallel_render_panel.parts)
+
+    if length <= parts:
+        yield (scn.frame_start, scn.frame_end)
+        return
+
+    # Precompute all split points in one comprehension and pair them
+    # up, rather than interleaving divisions with yields.
+    edges = [i * length // parts for i in range(parts + 1)]
+    for current, end in zip(edges, edges[1:]):
+        yield (offset + current, offset + end - 1)
+
+
+def get_ranges_fixed(scn):
+    start = scn.frame_start
+    end = scn.frame_end
+    increment = int(scn.parallel_render_panel.fixed)
+    while start <= end:
+        yield (start, min(start + increment, end))
+        start += increment + 1
+
+def coalesce_ranges(ranges, min_frames):
+    """Merge adjacent ranges so each batch has at least min_frames frames.
+
+    Very short batches spend more time on worker round-trips than on
+    rendering, so it is cheaper to hand them out merged.
+    """
+    coalesced = []
+    for start, end in ranges:
+        if coalesced and coalesced[-1][1] - coalesced[-1][0] + 1 < min_frames:
+            coalesced[-1] = (coalesced[-1][0], end)
+        else:
+            coalesced.append((start, end))
+
+    if len(coalesced) > 1 and coalesced[-1][1] - coalesced[-1][0] + 1 < min_frames:
+        last = coalesced.pop()
+        coalesced[-1] = (coalesced[-1][0], last[1])
+
+    return tuple(coalesced)
+
+
+RANGE_CALCULATORS = {
+    'parts': get_ranges_parts,
+    'fixed': get_ranges_fixed,
+}
+
+
+class ParallelRender(types.Operator):
+    """Render the Output from the Sequencer Multithreaded"""
+    bl_idname = "render.parallel_render"
+    bl_label = "Parallel Render"
+    bl_options = {'REGISTER'}
+
+    still_running = False
+    thread = None
+    state = None
+    subprocess_stdout = sys.stdout
+    subprocess_stderr = sys.stderr
+
+    def draw(self, context):
+        layout = self.layout
+        if _need_temporary_file(bpy.data):
+            _add_multiline_label(
+                layout,
+                [
+                    'Unsaved changes to project.',
+                    'Will attempt to create temporary file.',
+                ],
+                icon='ERROR',
+            )
+
+        layout.row().label(text='Will render frames from {} to {}'.format(context.scene.frame_start, context.scene.frame_end))
+
+    def __init__(self):
+        super(ParallelRender, self).__init__()
+        self._started = False
+        self._pending_futures = None
+        self._workers_mutex = Lock()
+        self._active_workers = set()
+        self._last_report = None
+        self._frames_done = 0
+        self._progress_dirty = True
+
+    def check(self, context):
+        return True
+
+    def _render_project_file(self, scn, project_file):
+        LOGGER.info("Going to render file %s", project_file)
+        self._started = True
+
+        props = scn.parallel_render_panel
+
+        ranges = coalesce_ranges(
+            tuple(RANGE_CALCULATORS[props.batch_type](scn)),
+            int(props.min_frames_per_batch),
+        )
+
+        cmds = tuple(
+            (
+                (start, end),
+                {
+                    '--scene': str(scn.name),
+                    '--start-frame': start,
+                    '--end-frame': end,
+                    '--overwrite': bool(props.overwrite),
+                }
+            )
+            for start, end in ranges
+        )
+
+        self.summary = {
+            'batches': len(cmds),
+            'batches_done': 0,
+            # Ranges are produced sorted and contiguous.
+            'frames': ranges[-1][1] - ranges[0][0] + 1,
+        }
+        self._frames_done = 0
+        RunResult = namedtuple('RunResult', ('range', 'command', 'rc', 'output_file'))
+
+        self.report({'INFO'}, 'Working on file {0}'.format(project_file))
+
+        pool = WorkerPool(
+            project_file=project_file,
+            subprocess_stdout=self.subprocess_stdout,
+            subprocess_stderr=self.subprocess_stderr,
+        )
+
+        # A single drain thread reads stats from all worker channels
+        # through a selector, so the pool threads spend their time
+        # dispatching work rather than each blocking in recv().
+        selector = selectors.DefaultSelector()
+        drain_wakeup_recv, drain_wakeup_send = socket.socketpair()
+        selector.register(drain_wakeup_recv, selectors.EVENT_READ)
+        new_tasks = Queue()
+
+        def _finish_task(task):
+            selector.unregister(task.channel._conn)
+            task.finished.set()
+
+        def _flush_frames(task):
+            # The drain thread is the only writer of _frames_done and
+            # int += is a single GIL-atomic store, so no lock is needed
+            # for readers on the UI thread to see a consistent value.
+            if task.pending_delta:
+                self._frames_done += task.pending_delta
+                task.pending_delta = 0
+                self._progress_dirty = True
+
+        def _handle_message(task):
+            try:
+                msg = task.channel.recv()
+            except Exception:
+                # The worker closed the connection before finishing
+                # the range -- it must have died.
+                msg = None
+            if msg is None:
+                _flush_frames(task)
+                _finish_task(task)
+            elif msg.get('task_done'):
+                # Frames between the last progress report and the end
+                # of the range are implied done; no final stats flush.
+                task.pending_delta += (task.range[1] - task.last_done + 1)
+                _flush_frames(task)
+                task.output_file = msg['output_file']
+                task.completed = True
+                _finish_task(task)
+            else:
+                frame_done = msg['frames'][-1]
+                # Accumulate the delta locally and only touch the
+                # shared counter once it is worth taking the lock.
+                task.pending_delta += (frame_done - task.last_done)
+                task.last_done = frame_done
+                task.output_file = msg.get('output_file', task.output_file)
+                if task.pending_delta >= STATS_BATCH_SIZE:
+                    _flush_frames(task)
+
+        def drain_channels():
+            running = True
+            while running:
+                for key, _mask in selector.select():
+                    task = key.data
+                    if task is None:
+                        drain_wakeup_recv.recv(4096)
+                        while True:
+                            try:
+                                task = new_tasks.get_nowait()
+                            except Empty:
+                                break
+                            if task is None:
+                                running = False
+                            else:
+                                selector.register(
+                                    task.channel._conn,
+                                    selectors.EVENT_READ,
+                                    task,
+                                )
+                    else:
+                        _handle_message(task)
+
+        def run_task(worker, rng, cmd):
+            task = _BatchTask(rng, worker.channel)
+            worker.channel.send(cmd)
+            new_tasks.put(task)
+            drain_wakeup_send.sendall(b'\0')
+            while not task.finished.wait(0.5):
+                if self.state != ParallelRenderState.RUNNING:
+                    return task.output_file, False
+            return task.output_file, task.completed
+
+        def run(args):
+            rng, cmd = args
+            res = None
+            output_file = None
+
+            if self.state == ParallelRenderState.RUNNING:
+                worker = None
+                try:
+                    worker = pool.acquire()
+                    with self._workers_mutex:
+                        self._active_workers.add(worker)
+                    try:
+                        output_file, done = run_task(worker, rng, cmd)
+                    finally:
+                        with self._workers_mutex:
+                            self._active_workers.discard(worker)
+
+                    if done:
+                        res = 0
+                        pool.release(worker)
+                        LOGGER.info('Worker finished writing %s', output_file)
+                    else:
+                        res = pool.discard(worker)
+                        if res in (0, None):
+                            res = -1
+                except Exception as exc:
+                    LOGGER.exception(exc)
+                    res = -1
+                    if worker is not None:
+                        try:
+                            pool.discard(worker)
+                        except Exception:
+                            LOGGER.exception('Failed to clean up worker')
+            return RunResult(rng, cmd, res, output_file)
+
+        self.state = ParallelRenderState.RUNNING
+        self.report({'INFO'}, 'Starting 0/{0} [0.0%]'.format(
+            len(cmds)
+        ))
+
+        # Only the output paths of successful batches are kept (for
+        # concatenation and clean-up); failures are handled as they
+        # stream in rather than collected for a post-run scan.
+        output_files = []
+        drain_thread = Thread(target=drain_channels, name='parallel_render_drain')
+        drain_thread.daemon = True
+        drain_thread.start()
+        try:
+            with pool:
+                with ThreadPoolExecutor(max_workers=props.max_parallel) as executor:
+                    self._pending_futures = futures = [executor.submit(run, cmd) for cmd in cmds]
+                    num = 0
+                    for future in as_completed(futures):
+                        if future.cancelled():
+                            continue
+                        res = future.result()
+                        num += 1
+                        # Single writer (this thread); GIL-atomic store.
+                        self.summary['batches_done'] = num
+                        self._progress_dirty = True
+                        LOGGER.info('Result: %s', res)
+                        # Flag failure as soon as it happens rather than
+                        # rescanning all results after the loop.
+                        if res.rc == 0:
+                            output_files.append((res.range, res.output_file))
+                        else:
+                            if self.state != ParallelRenderState.FAILED:
+                                self.state = ParallelRenderState.FAILED
+                                # No point finishing work we will throw
+                                # away; drop queued batches and stop the
+                                # in-flight workers.
+                                self._cancel_pending_batches()
+                                self._terminate_active_workers()
+                            if res.output_file is not None:
+                                LOGGER.error('Cleaning up failed %s', res.output_file)
+                                try:
+                                    os.unlink(res.output_file)
+                                except OSError as exc:
+                                    assert exc.errno == errno.ENOENT
+                        self._report_progress()
+                self._pending_futures = None
+        finally:
+            new_tasks.put(None)
+            drain_wakeup_send.sendall(b'\0')
+            drain_thread.join()
+            selector.close()
+            drain_wakeup_recv.close()
+            drain_wakeup_send.close()
+
+        self._report_progress()
+
+        sound_path = os.path.abspath(os.path.splitext(scn.render.frame_path())[0] + '.mp3')
+        if self.state == self.state.RUNNING and props.mixdown:
+            self.state = ParallelRenderState.MIXDOWN
+            self.report({'INFO'}, 'Mixing down sound')
+            LOGGER.info('Going to mixdown to %s', sound_path)
+            bpy.ops.sound.mixdown(filepath=sound_path)
+            self._report_progress()
+            self.state = ParallelRenderState.RUNNING
+
+        LOGGER.debug('Checkpoint %s %s %s', self.state, props.concatenate, _can_concatenate(scn))
+        if self.state == ParallelRenderState.RUNNING and props.concatenate and _can_concatenate(scn):
+            self.state = ParallelRenderState.CONCATENATE
+            self.report({'INFO'}, 'Concatenating')
+
+            # Pipe the concat list straight into ffmpeg instead of
+            # round-tripping it through a temp file next to the project.
+            concat_list = ''.join(
+                "file '{}'\n".format(filename)
+                for _range, filename in sorted(output_files)
+            ).encode('utf8')
+
+            outfile = bpy.context.scene.render.frame_path()
+            LOGGER.info('Final render name: %s', outfile)
+
+            sound = ()
+            if props.mixdown:
+                sound = ('-i', sound_path, '-codec:a', 'copy', '-q:a', '0')
+
+            overwrite = ('-y' if bool(props.overwrite) else '-n',)
+
+            base_cmd = (
+                self.ffmpeg_executable,
+                '-f', 'concat',
+                '-safe', '0',
+                '-protocol_whitelist', 'file,pipe',
+                '-i', '-',
+                '-codec:v', 'copy',
+                outfile,
+            )
+
+            cmd = base_cmd + sound + overwrite
+
+            LOGGER.info('Running: %s', cmd)
+            res = subprocess.run(
+                cmd,
+                input=concat_list,
+                stdout=self.subprocess_stdout,
+                stderr=self.subprocess_stderr,
+            ).returncode
+            LOGGER.info('Finished running [rc: %s]: %s',  res, cmd)
+            if res == 0:
+                self.state = self.state.RUNNING
+            else:
+                self.state = self.state.FAILED
+
+            assert os.path.exists(outfile)
+
+        if self.state == ParallelRenderState.RUNNING and props.clean_up_parts:
+            LOGGER.info('Going to clean up parts (%s)', output_files)
+            self.state = ParallelRenderState.CLEANING
+            to_clean = [sound_path]
+            to_clean.extend(filename for _range, filename in output_files)
+            # Unlinks are independent and latency-bound on slow or
+            # networked filesystems, so overlap them.
+            with ThreadPoolExecutor(max_workers=min(8, len(to_clean))) as cleaner:
+                for _ in cleaner.map(os.unlink, to_clean):
+                    pass
+            self.state = ParallelRenderState.RUNNING
+
+    def _cancel_pending_batches(self):
+        futures = self._pending_futures
+        if futures is not None:
+            for future in futures:
+                future.cancel()
+
+    def _terminate_active_workers(self):
+        with self._workers_mutex:
+            workers = tuple(self._active_workers)
+        for worker in workers:
+            worker.terminate()
+
+    def _run(self, scn):
+        props = scn.parallel_render_panel
+        props.last_run_result = 'pending'
+
+        if _need_temporary_file(bpy.data):
+            work_project_file = TemporaryProjectCopy()
+        else:
+            work_project_file = CurrentProjectFile()
+
+        try:
+            with work_project_file:
+                self._render_project_file(scn, work_project_file.path)
+            props.last_run_result = 'done' if self.state == ParallelRenderState.RUNNING else 'failed'
+        except Exception as exc:
+            LOGGER.exception(exc)
+            props.last_run_result = 'failed'
+
+    def _report_progress(self):
+        rep_type, action = self.state.describe()
+        # The render threads flip _progress_dirty whenever a counter
+        # moves, so idle timer ticks skip the lock entirely (unless
+        # the state itself changed since the last report).
+        if not self._progress_dirty and self._last_report is not None \
+                and self._last_report[0] == self.state:
+            return
+        self._progress_dirty = False
+        # Each counter has a single writer thread, so plain reads give
+        # a recent, internally-consistent enough snapshot without ever
+        # contending with the render threads.
+        batches_done = self.summary['batches_done']
+        batches = self.summary['batches']
+        frames_done = self._frames_done
+        frames = self.summary['frames']
+        # The timer ticks more often than progress changes; only
+        # bother Blender with a report when there is news.
+        report = (self.state, batches_done, frames_done)
+        if report == self._last_report:
+            return
+        self._last_report = report
+        self.report({rep_type}, '{0} Batches: {1}/{2} Frames: {3}/{4} [{5:.1f}%]'.format(
+            action.replace('ing', 'ed'),
+            batches_done,
+            batches,
+            frames_done,
+            frames,
+            100.0 * frames_done / frames
+        ))
+
+    def execute(self, context):
+        scn = context.scene
+        wm = context.window_manager
+        # A fast tick is affordable now that idle ticks bail out on
+        # the dirty flag before doing any real work; batch completions
+        # show up in the UI sooner.
+        self.timer = wm.event_timer_add(0.1, window=context.window)
+        wm.modal_handler_add(self)
+        wm.progress_begin(0., 100.)
+
+        addon_props = context.preferences.addons[__name__].preferences
+
+        self.max_parallel = scn.parallel_render_panel.max_parallel
+        self.ffmpeg_executable = addon_props.ffmpeg_executable
+
+        self.thread = Thread(target=self._run, args=(scn,))
+        self.thread.start()
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if not self._started:
+            return {'PASS_THROUGH'}
+
+        wm = context.window_manager
+
+        # Stop the thread when ESCAPE is pressed.
+        if event.type == 'ESC':
+            self.state = ParallelRenderState.CANCELLING
+            self._cancel_pending_batches()
+            self._terminate_active_workers()
+            self._report_progress()
+
+        if event.type == 'TIMER':
+            still_running = self.thread.is_alive()
+            percent = 100.0 * self.summary['batches_done'] / self.summary['batches']
+
+            if still_running:
+                wm.progress_update(percent)
+                self._report_progress()
+                return {'PASS_THROUGH'}
+
+            self.thread.join()
+            wm.event_timer_remove(self.timer)
+            wm.progress_end()
+            return {'FINISHED'}
+
+        return {'PASS_THROUGH'}
+
+    def invoke(self, context, event):
+        wm = context.window_manager
+        return wm.invoke_props_dialog(self)
+
+
+class _BatchTask(object):
+    """Controller-side progress state for one range on one worker."""
+
+    def __init__(self, rng, channel):
+        self.range = rng
+        self.channel = channel
+        self.output_file = None
+        self.last_done = rng[0]
+        self.pending_delta = 0
+        self.completed = False
+        self.finished = Event()
+
+
+# How many frames to accumulate before pushing a progress
+# message to the controller (and how long at most to sit on them).
+STATS_BATCH_SIZE = 16
+STATS_FLUSH_INTERVAL = 0.25
+# Only record every Nth frame; the controller works off deltas, so
+# skipped frames are still accounted for by the next recorded one.
+STATS_FRAME_STRIDE = 4
+
+
+def _render_range(channel, args):
+    scn_name = args['--scene']
+    scn = bpy.data.scenes[scn_name]
+    scn.frame_start = args['--start-frame']
+    scn.frame_end = args['--end-frame']
+
+    outfile = bpy.context.scene.render.frame_path()
+
+    pending_frames = []
+    last_flush = time.monotonic()
+    last_frame = scn.frame_start - STATS_FRAME_STRIDE
+
+    def _update_progress(_ignored):
+        # Read through the already-resolved scene instead of doing a
+        # bpy.context lookup for every frame.
+        send_stats(scn.frame_current)
+
+    def send_stats(frame):
+        nonlocal last_flush, last_frame
+        now = time.monotonic()
+        if not (
+            frame - last_frame >= STATS_FRAME_STRIDE
+            or now - last_flush > STATS_FLUSH_INTERVAL
+        ):
+            return
+        last_frame = frame
+        pending_frames.append(frame)
+        if not (
+            len(pending_frames) >= STATS_BATCH_SIZE
+            or now - last_flush > STATS_FLUSH_INTERVAL
+        ):
+            return
+        channel.send({
+            'output_file': outfile,
+            'frames': pending_frames,
+        })
+        pending_frames.clear()
+        last_flush = now
+
+    LOGGER.info("Writing file {}".format(outfile))
+    if args['--overwrite'] or not os.path.exists(outfile):
+        bpy.app.handlers.render_stats.append(_update_progress)
+        try:
+            bpy.ops.render.render(animation=True, scene=scn_name)
+        finally:
+            bpy.app.handlers.render_stats.remove(_update_progress)
+    else:
+        LOGGER.warning('%s already exists.', outfile)
+
+    LOGGER.info("Done writing {}".format(outfile))
+    assert os.path.exists(outfile)
+    # The controller accounts for any unreported tail frames when it
+    # sees task_done, so no final stats flush is needed.
+    channel.send({'task_done': True, 'output_file': outfile})
+
+
+def render():
+    channel = WorkerProcess.read_config()
+    with channel:
+        try:
+            # Keep rendering ranges until the controller says we are
+            # done; this blender instance only pays the startup and
+            # project load cost once for all of them.
+            for args in iter(channel.recv, None):
+                _render_range(channel, args)
+        finally:
+            channel.send(None)
+    sys.exit(0)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    covstart = os.environ.get('COVERAGE_PROCESS_START')
+    if covstart is not None:
+        sys.path.extend(os.environ['PYTHONPATH'].split(':'))
+        logging.info('sys.path: %s', sys.path)
+        import coverage
+        coverage.process_startup()
+
+    # Get everything after '--' as those are arguments
+    # to our script
+    args = sys.argv[sys.argv.index('--') + 1:]
+
+    action = args[0]
+
+    if action == 'render':
+        render()
+
+CLASSES = (
+    ParallelRenderPropertyGroup,
+    ParallelRenderPreferences,
+    ParallelRender,
+    ParallelRenderPanel,
+)
+
+def register():
+    for cls in CLASSES:
+        bpy.utils.register_class(cls)
+
+    bpy.types.Scene.parallel_render_panel = bpy.props.PointerProperty(type=ParallelRenderPropertyGroup)
+    # TODO: I am not quite sure how to put it after actual "Render Animation"
+    bpy.types.TOPBAR_MT_render.prepend(parallel_render_menu_draw)
+
+
+def unregister():
+    bpy.types.TOPBAR_MT_render.remove(parallel_render_menu_draw)
+    del bpy.types.Scene.parallel_render_panel
+    for cls in reversed(CLASSES):
+        bpy.utils.unregister_class(cls)
+
+if __name__ == "__main__":
+    main()
@@ -5,15 +5,18 @@ To run:
 PYTHONPATH=tests python3.6 tests/parallel_render.py test <path to blender> <path to ffmpeg executable>
 
 """
+from concurrent.futures import Future
 from itertools import product
 from time import sleep
 from unittest import mock
 import logging
 import os
 import shutil
+import socket
 import struct
 import subprocess
 import sys
+import threading
 import unittest
 
 BLENDER_EXECUTABLE = None
@@ -48,10 +51,16 @@ class MessageChannelTest(BlenderTest):
         conn = mock.MagicMock()
 
         channel = parallel_render.MessageChannel(conn)
+        conn.recv_into.return_value = 0
         with self.assertRaises(Exception):
             channel.recv()
 
-        conn.recv.side_effect = [struct.pack(channel.MSG_SIZE_FMT, 0), None]
+        def _recv_zero_size(view):
+            packed = struct.pack(channel.MSG_SIZE_FMT, 0)
+            view[:len(packed)] = packed
+            return len(packed)
+
+        conn.recv_into.side_effect = _recv_zero_size
         self.assertEqual(channel.recv(), None)
 
 class TemporaryProjectTest(BlenderTest):
@@ -207,6 +216,36 @@ class RangesTest(BlenderTest):
             list(parallel_render.get_ranges_fixed(scene)),
         )
 
+    def test_coalesce_ranges_noop(self):
+        import parallel_render
+
+        self.assertEqual(
+            ((1, 10), (11, 20)),
+            parallel_render.coalesce_ranges(((1, 10), (11, 20)), 1),
+        )
+
+    def test_coalesce_ranges_merges_small(self):
+        import parallel_render
+
+        self.assertEqual(
+            ((1, 8), (9, 20)),
+            parallel_render.coalesce_ranges(
+                ((1, 4), (5, 8), (9, 12), (13, 20)),
+                8,
+            ),
+        )
+
+    def test_coalesce_ranges_merges_trailing(self):
+        import parallel_render
+
+        self.assertEqual(
+            ((1, 12),),
+            parallel_render.coalesce_ranges(
+                ((1, 8), (9, 12)),
+                8,
+            ),
+        )
+
     def test_small2_fixed(self):
         import parallel_render
 
@@ -241,7 +280,7 @@ class MockedDrawTest(BlenderTest):
         event = mock.MagicMock()
 
         operator = mock.MagicMock()
-        operator.summary_mutex = None
+        operator._started = False
         self.assertEqual(
             {'PASS_THROUGH'},
             parallel_render.ParallelRender.modal(operator, context, event)
@@ -703,11 +742,11 @@ class ParallelRenderTest(BlenderTest):
 
     def test_with_ffmpeg_concat_failure(self):
         self._setup_common_video()
-        with mock.patch('subprocess.call') as call:
-            call.side_effect = [-1]
+        with mock.patch('subprocess.run') as run:
+            run.side_effect = [mock.MagicMock(returncode=-1)]
             self._render_video(expected_state='failed')
-            self.assertEqual(call.call_args[0][0][0], self.FFMPEG_EXECUTABLE)
-            self.assertEqual(call.call_count, 1) # should only be called for running ffmpeg
+            self.assertEqual(run.call_args[0][0][0], self.FFMPEG_EXECUTABLE)
+            self.assertEqual(run.call_count, 1) # should only be called for running ffmpeg
             # Expect all prats, but not concatenated bit
             self.assertEqual(
                 sorted(fname for fname in os.listdir('output/') if fname[0] != '.'),
@@ -721,56 +760,123 @@ class ParallelRenderTest(BlenderTest):
             )
 
     def test_with_custom_failures(self):
+        import parallel_render
+
         self._setup_common_video()
 
         base_dir = os.path.realpath('output')
 
-        def create_output(filepath, rc):
-            process_mock = mock.MagicMock()
-            if filepath is not None:
-                filepath = os.path.join(base_dir, filepath)
-                LOGGER.info('Creating dummy file %s', filepath)
-                with open(filepath, 'w'):
-                    pass
-            process_mock.returncode = int(rc)
-            process_mock.wait.return_value = int(rc)
-            return process_mock
-
-        processes = iter((
-            create_output(filepath='test0001-0009.avi', rc=0),
-            create_output(filepath=None, rc=-11),
-            create_output(filepath='test0019-0027.avi', rc=1),
-            create_output(filepath=None, rc=-12),
+        class ScriptedWorker:
+            """Stands in for WorkerProcess, answering each dispatched
+            task with a canned list of messages over a real socket so
+            the controller's drain thread is exercised for real."""
+
+            def __init__(self, script, rc, filepath):
+                if filepath is not None:
+                    filepath = os.path.join(base_dir, filepath)
+                    LOGGER.info('Creating dummy file %s', filepath)
+                    with open(filepath, 'w'):
+                        pass
+                self.return_code = int(rc)
+                controller_end, worker_end = socket.socketpair()
+                self.channel = parallel_render.MessageChannel(controller_end)
+                self._worker_channel = parallel_render.MessageChannel(worker_end)
+                self._script = script
+                self._thread = threading.Thread(target=self._feed)
+                self._thread.start()
+
+            def _feed(self):
+                for messages in self._script:
+                    self._worker_channel.recv()
+                    for msg in messages:
+                        self._worker_channel.send(msg)
+
+            def terminate(self):
+                pass
+
+            def stop(self):
+                self._thread.join()
+                self._worker_channel._conn.close()
+                self.channel._conn.close()
+                return self.return_code
+
+        def output_file(name):
+            return os.path.join(base_dir, name)
+
+        # First worker does the first range, gets reused for the
+        # second one and dies mid-way (clean rc forced to failure).
+        # The next two die on their first range.
+        workers = iter((
+            ScriptedWorker(
+                script=[
+                    [
+                        {'output_file': output_file('test0001-0009.avi'), 'frames': [8, 9]},
+                        {'task_done': True, 'output_file': output_file('test0001-0009.avi')},
+                    ],
+                    [
+                        {'output_file': output_file('test0010-0018.avi'), 'frames': [12]},
+                        None,
+                    ],
+                ],
+                rc=0,
+                filepath='test0001-0009.avi',
+            ),
+            ScriptedWorker(
+                script=[
+                    [
+                        {'output_file': output_file('test0019-0027.avi'), 'frames': [24, 25]},
+                        None,
+                    ],
+                ],
+                rc=1,
+                filepath='test0019-0027.avi',
+            ),
+            ScriptedWorker(script=[[None]], rc=-12, filepath=None),
         ))
 
-        with mock.patch('parallel_render.Pool') as Pool:
-            Pool().__enter__().imap_unordered = map
-            Pool().__enter__().map = map
-            with mock.patch('subprocess.Popen') as Popen:
-                Popen.side_effect = lambda *_, **_kw: next(processes)
-                with mock.patch('parallel_render.MessageChannel') as MessageChannel:
-                    MessageChannel().recv.side_effect = [
-                        {'output_file': os.path.join(base_dir, 'test0001-0009.avi'), 'current_frame': 11},
-                        None,
+        class ScriptedPool:
+            def __init__(self, *args, **kwargs):
+                self._idle = []
 
-                        {'output_file': os.path.join(base_dir, 'test0010-0018.avi'), 'current_frame': 12},
-                        None,
+            def __enter__(self):
+                return self
 
-                        {'output_file': os.path.join(base_dir, 'test0019-0027.avi'), 'current_frame': 25},
-                        None,
+            def __exit__(self, exc_t, exc_v, tb):
+                self.shutdown()
 
-                        None,
-                    ]
-                    with mock.patch('socket.socket') as socket:
-                        socket().getsockname.return_value = 'does not matter'
-                        socket().accept.return_value = (mock.MagicMock(), mock.MagicMock())
-                        self._render_video(expected_state='failed')
-
-                        # Expect nothing, as we can't Popen
-                        self.assertEqual(
-                            sorted(fname for fname in os.listdir('output/') if fname[0] != '.'),
-                            ['test0001-0009.avi']
-                        )
+            def acquire(self):
+                if self._idle:
+                    return self._idle.pop()
+                return next(workers)
+
+            def release(self, worker):
+                self._idle.append(worker)
+
+            def discard(self, worker):
+                return worker.stop()
+
+            def shutdown(self):
+                while self._idle:
+                    self._idle.pop().stop()
+
+        def inline_submit(fn, *args, **kwargs):
+            future = Future()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as exc:
+                future.set_exception(exc)
+            return future
+
+        # Run the batches sequentially so worker reuse is deterministic.
+        with mock.patch('parallel_render.ThreadPoolExecutor') as ThreadPoolExecutor:
+            ThreadPoolExecutor().__enter__().submit = inline_submit
+            with mock.patch('parallel_render.WorkerPool', ScriptedPool):
+                self._render_video(expected_state='failed')
+
+                self.assertEqual(
+                    sorted(fname for fname in os.listdir('output/') if fname[0] != '.'),
+                    ['test0001-0009.avi']
+                )
 
 def _run_tests(args):
     BlenderTest.FFMPEG_EXECUTABLE = args[2]